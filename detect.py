@@ -108,7 +108,8 @@ def detect(model, images, input_size):
 
     with torch.no_grad():
         score_maps, geo_maps = model(batch)
-    score_maps, geo_maps = score_maps.cpu().numpy(), geo_maps.cpu().numpy()
+    # the output head already runs in fp32 (see EAST.forward); .float() is a no-op safeguard
+    score_maps, geo_maps = score_maps.float().cpu().numpy(), geo_maps.float().cpu().numpy()
 
     by_sample_bboxes = []
     for score_map, geo_map, orig_size in zip(score_maps, geo_maps, orig_sizes):
@@ -174,8 +174,19 @@ def is_cross_text(start_loc, length, vertices):
     if vertices.size == 0:
         return False
     start_w, start_h = start_loc
-    a = np.array([start_w, start_h, start_w + length, start_h, start_w + length, start_h + length,
-                  start_w, start_h + length]).reshape((4, 2))
+    end_w, end_h = start_w + length, start_h + length
+
+    # text regions fully inside or fully outside the crop never cross it, so only the
+    # regions whose bounding box straddles the crop border need the polygon intersection
+    x_min, x_max = vertices[:, 0::2].min(axis=1), vertices[:, 0::2].max(axis=1)
+    y_min, y_max = vertices[:, 1::2].min(axis=1), vertices[:, 1::2].max(axis=1)
+    inside = (x_min >= start_w) & (x_max <= end_w) & (y_min >= start_h) & (y_max <= end_h)
+    outside = (x_max <= start_w) | (x_min >= end_w) | (y_max <= start_h) | (y_min >= end_h)
+    vertices = vertices[~(inside | outside)]
+    if vertices.size == 0:
+        return False
+
+    a = np.array([start_w, start_h, end_w, start_h, end_w, end_h, start_w, end_h]).reshape((4, 2))
     p1 = Polygon(a).convex_hull
     for vertice in vertices:
         p2 = Polygon(vertice.reshape((4, 2))).convex_hull
@@ -255,6 +266,31 @@ def rotate_all_pixels(rotate_mat, anchor_x, anchor_y, length):
     return rotated_x, rotated_y
 
 
+def draft_img(img, vertices, size):
+    '''let the JPEG decoder downscale (1/2, 1/4, 1/8) while decoding the image
+    Input:
+        img         : PIL Image, not loaded yet
+        vertices    : vertices of text regions <numpy.ndarray, (n,8)>
+        size        : length of the longer side after resize_img
+    Output:
+        img         : PIL Image whose sides are still >= the resize_img output
+        new_vertices: vertices in the drafted image
+    '''
+    h, w = img.height, img.width
+    ratio = size / max(h, w)
+    if ratio >= 1:
+        return img, vertices
+    img.draft('RGB', (math.ceil(w * ratio), math.ceil(h * ratio)))
+    if (img.height, img.width) == (h, w):
+        return img, vertices
+
+    new_vertices = vertices.copy()
+    if vertices.size > 0:
+        new_vertices[:,[0,2,4,6]] = vertices[:,[0,2,4,6]] * (img.width / w)
+        new_vertices[:,[1,3,5,7]] = vertices[:,[1,3,5,7]] * (img.height / h)
+    return img, new_vertices
+
+
 def resize_img(img, vertices, size):
     h, w = img.height, img.width
     ratio = size / max(h, w)
@@ -301,10 +337,11 @@ def rotate_img(img, vertices, angle_range=10):
     center_y = (img.height - 1) / 2
     angle = angle_range * (np.random.rand() * 2 - 1)
     img = img.rotate(angle, Image.BILINEAR)
-    new_vertices = np.zeros(vertices.shape)
-    for i, vertice in enumerate(vertices):
-        new_vertices[i,:] = rotate_vertices(vertice, -angle / 180 * math.pi, np.array([[center_x],[center_y]]))
-    return img, new_vertices
+    # rotate every vertex at once (same as rotate_vertices() on each text region)
+    rotate_mat = get_rotate_mat(-angle / 180 * math.pi)
+    anchor = np.array([center_x, center_y])
+    new_vertices = np.dot(vertices.reshape((-1, 2)) - anchor, rotate_mat.T) + anchor
+    return img, new_vertices.reshape(vertices.shape)
 
 
 def generate_roi_mask(image, vertices, labels):
@@ -347,6 +384,20 @@ class SceneTextDataset(Dataset):
         self.image_size, self.crop_size = image_size, crop_size
         self.color_jitter, self.normalize = color_jitter, normalize
 
+        # build the albumentations pipeline once instead of on every __getitem__
+        funcs = []
+        if self.split == 'train':
+            if self.color_jitter:
+                funcs.append(A.ColorJitter(0.5, 0.5, 0.5, 0.25))
+            funcs.append(A.CLAHE(clip_limit=4.0))
+            funcs.append(A.GaussNoise(p=0.5))
+            funcs.append(A.ISONoise(p=0.5))
+            funcs.append(A.ChannelShuffle(p=0.5))
+            if self.normalize:
+                funcs.append(A.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)))
+        # val images are returned as raw uint8 RGB: detect() does its own resize/normalize
+        self.transform = A.Compose(funcs)
+
     def __len__(self):
         return len(self.image_fnames)
 
@@ -362,36 +413,20 @@ class SceneTextDataset(Dataset):
 
         vertices, labels = filter_vertices(vertices, labels, ignore_under=10, drop_under=1)
 
-        funcs = []
         image = Image.open(image_fpath)
 
         if self.split=='train':
+            image, vertices = draft_img(image, vertices, self.image_size)
             image, vertices = resize_img(image, vertices, self.image_size)
             image, vertices = adjust_height(image, vertices)
             image, vertices = rotate_img(image, vertices)
             image, vertices = crop_img(image, vertices, labels, self.crop_size)
 
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            image = np.array(image)
-            if self.color_jitter:
-                funcs.append(A.ColorJitter(0.5, 0.5, 0.5, 0.25))
-            funcs.append(A.CLAHE(clip_limit=4.0))
-            funcs.append(A.GaussNoise(p=0.5))
-            funcs.append(A.ISONoise(p=0.5))
-            funcs.append(A.ChannelShuffle(p=0.5))
-            if self.normalize:
-                funcs.append(A.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)))
-            
-
-        else:
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            image = np.array(image)
-            funcs.append(A.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image = np.array(image)
 
-        transform = A.Compose(funcs)    
-        image = transform(image=image)['image']
+        image = self.transform(image=image)['image']
         word_bboxes = np.reshape(vertices, (-1, 4, 2))
 
         if self.split == 'train':
@@ -3,22 +3,28 @@ import os
 import errno
 import os.path as osp
 import time
-import math
+import inspect
 from datetime import datetime, timedelta
-from argparse import ArgumentParser
+from functools import partial
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser, ArgumentTypeError
 
 import torch
+import torch.distributed as dist
 from torch import cuda
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, DistributedSampler
 from torch.optim import lr_scheduler
 from tqdm import tqdm
 
 import numpy as np
 import random
 
-from east_dataset import EASTDataset
+from east_dataset import EASTDataset, CachedEASTDataset
 from dataset import SceneTextDataset
 from model import EAST
+from prefetcher import CUDAPrefetcher
 
 import wandb
 
@@ -34,6 +40,36 @@ def symlink_force(target, link_name):
             raise e
 
 
+def cpu_state_dict(model):
+    # 학습이 계속 진행되어도 저장되는 값이 바뀌지 않도록 항상 CPU 사본을 만듦
+    return {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+
+
+def save_checkpoint(state_dict, ckpt_fpath, link_fpath=None):
+    # ckpt_executor thread에서 실행: 저장이 끝난 뒤에 symlink를 갱신해서 link가 미완성 파일을 가리키지 않도록 함
+    torch.save(state_dict, ckpt_fpath)
+    if link_fpath is not None:
+        symlink_force(osp.basename(ckpt_fpath), link_fpath)
+
+
+def str2bool(v):
+    if isinstance(v, bool):
+       return v
+    if v.lower() in ('yes', 'true', 't', 'y', '1'):
+        return True
+    elif v.lower() in ('no', 'false', 'f', 'n', '0'):
+        return False
+    else:
+        raise ArgumentTypeError('Boolean value expected.')
+
+
+def seed_worker(worker_id, seed):
+    worker_seed = seed + worker_id
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+    torch.manual_seed(worker_seed)
+
+
 def parse_args():
     parser = ArgumentParser()
 
@@ -55,73 +91,195 @@ def parse_args():
     parser.add_argument('--wandb_name', type=str, default='Unnamed Test')
     parser.add_argument('--seed', type=int, default=42)
     parser.add_argument('--early_stop', type=int, default=201)
+    parser.add_argument('--amp', type=str2bool, default=cuda.is_available())
+    parser.add_argument('--deterministic', type=str2bool, default=False)
+    parser.add_argument('--accum_steps', type=int, default=1)
+    parser.add_argument('--log_interval', type=int, default=50)
+    parser.add_argument('--cache_dir', type=str, default=None)
+    parser.add_argument('--torch_compile', type=str2bool, default=cuda.is_available() and hasattr(torch, 'compile'))
 
     args = parser.parse_args()
 
     if args.input_size % 32 != 0:
         raise ValueError('`input_size` must be a multiple of 32')
 
+    if args.accum_steps < 1:
+        raise ValueError('`accum_steps` must be a positive integer')
+
+    if args.log_interval < 1:
+        raise ValueError('`log_interval` must be a positive integer')
+
     return args
 
 
 def do_training(data_dir, model_dir, device, image_size, input_size, num_workers, batch_size,
-                learning_rate, max_epoch, save_interval, wandb_name, seed, early_stop):
+                learning_rate, max_epoch, save_interval, wandb_name, seed, early_stop, amp, deterministic,
+                torch_compile, accum_steps, log_interval, cache_dir):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed) # if use multi-GPU
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    if deterministic:
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+    else:
+        # input_size가 고정이므로 첫 batch의 cuDNN autotune 비용은 바로 상쇄됨
+        torch.backends.cudnn.deterministic = False
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
     np.random.seed(seed)
     random.seed(seed)
 
+    # torchrun으로 실행한 경우(LOCAL_RANK 환경변수 존재) DDP로 multi-GPU 학습
+    distributed = 'LOCAL_RANK' in os.environ
+    if distributed:
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+        dist.init_process_group('nccl')
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        device = torch.device('cuda', local_rank)
+    else:
+        rank, world_size = 0, 1
+    # wandb 로깅, 출력, checkpoint 저장은 rank 0에서만 수행
+    is_main = rank == 0
+
     dataset = SceneTextDataset(data_dir, split='train', image_size=image_size, crop_size=input_size)
     dataset = EASTDataset(dataset)
-    num_batches = math.ceil(len(dataset) / batch_size)
-    train_loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers, worker_init_fn=np.random.seed(seed))
+    if cache_dir is not None:
+        cache_meta = dict(data_dir=osp.abspath(data_dir), split='train', image_size=image_size,
+                          crop_size=input_size, map_scale=dataset.map_scale)
+        dataset = CachedEASTDataset(dataset, cache_dir, meta=cache_meta)
+        if is_main:
+            # cache에는 처음 만들 때의 random augmentation 결과가 그대로 저장되므로 epoch마다 같은 sample이 나옴
+            print('[Warning] --cache_dir freezes the random train augmentation (crop, rotation, color jitter, '
+                  'noise) drawn on the first pass: every later epoch sees the same sample per index')
+    if not distributed:
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    # worker는 epoch마다 재생성하지 않고 유지(persistent), seed는 worker별로 다르게 설정
+    worker_kwargs = dict(worker_init_fn=partial(seed_worker, seed=seed + rank * num_workers),
+                         persistent_workers=True, prefetch_factor=4) if num_workers > 0 else dict()
+    train_sampler = DistributedSampler(dataset, shuffle=True, seed=seed) if distributed else None
+    train_loader = DataLoader(dataset, batch_size=batch_size, shuffle=train_sampler is None, sampler=train_sampler,
+                              num_workers=num_workers, pin_memory=device.type == 'cuda', **worker_kwargs)
+    num_batches = len(train_loader)
+    # epoch 마지막 accumulation group은 accum_steps보다 작을 수 있으므로 시작 위치를 미리 계산
+    last_group_start = num_batches - num_batches % accum_steps
+    train_prefetcher = CUDAPrefetcher(train_loader, device, memory_format=torch.channels_last)
 
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     model = EAST()
-    model.to(device)
-    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, betas=(0.9,0.999), weight_decay=0.01)
+    model.to(device, memory_format=torch.channels_last)
+    criterion = model.criterion
+    model_without_ddp = model
+    if distributed:
+        model = DDP(model, device_ids=[local_rank], bucket_cap_mb=25, gradient_as_bucket_view=True)
+        if torch_compile:
+            # DDP로 감싼 model을 compile해야 DDPOptimizer가 bucket 경계에서 graph를 나눠서
+            # all-reduce가 backward와 겹쳐짐 (CUDA graph를 쓰는 reduce-overhead mode는 사용하지 않음)
+            model = torch.compile(model, dynamic=False)
+    # 학습 step에서만 쓰는 forward. model.forward는 eager로 두어 학습 외의 호출이 학습용 CUDA graph를
+    # 재compile하거나 별도 memory pool을 만들지 않도록 함
+    train_forward = model
+    if torch_compile and not distributed:
+        # loss 계산(data-dependent 분기 포함)은 제외하고 forward만 compile → state_dict key도 그대로 유지됨
+        train_forward = torch.compile(model.forward, mode='reduce-overhead', dynamic=False)
+    # fused(단일 CUDA 커널) → foreach(multi-tensor) 순으로 지원되는 AdamW 구현 사용
+    adamw_params = inspect.signature(torch.optim.AdamW).parameters
+    adamw_kwargs = dict()
+    if torch.device(device).type == 'cuda':
+        if 'fused' in adamw_params:
+            adamw_kwargs['fused'] = True
+        elif 'foreach' in adamw_params:
+            adamw_kwargs['foreach'] = True
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, betas=(0.9,0.999), weight_decay=0.01,
+                                  **adamw_kwargs)
     scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=[max_epoch // 2], gamma=0.1)
+    scaler = torch.cuda.amp.GradScaler(enabled=amp)
+    # checkpoint의 디스크 저장은 별도 thread에서 수행해서 학습 loop를 막지 않도록 함
+    ckpt_executor = ThreadPoolExecutor(max_workers=1)
+    ckpt_futures = []
+    # checkpoint 경로 관련 값은 학습 시작 전에 한 번만 준비
+    if is_main:
+        os.makedirs(model_dir, exist_ok=True)
+    best_ckpt_fpath, latest_link_fpath = osp.join(model_dir, 'best_model.pth'), osp.join(model_dir, "latest.pth")
 
     early_stop_cnt=0
     best_score = 9999 #현재는 epoch_loss기준이라 이렇게 설정
     model.train()
+    global_step = 0
     for epoch in range(max_epoch):
-        epoch_loss, epoch_start = 0, time.time()
-        with tqdm(total=num_batches) as pbar:
-            for img, gt_score_map, gt_geo_map, roi_mask in train_loader:
-                pbar.set_description('[Epoch {}]'.format(epoch + 1))
-
-                loss, extra_info = model.train_step(img, gt_score_map, gt_geo_map, roi_mask)
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-
-                loss_val = loss.item()
-                epoch_loss += loss_val
+        # epoch loss는 GPU에서 누적하고 epoch이 끝날 때 한 번만 동기화
+        epoch_loss, epoch_start = torch.zeros((), device=device), time.time()
+        step_values, epoch_values = [], torch.zeros(3)
+        if distributed:
+            train_sampler.set_epoch(epoch)
+        # 화면 갱신은 최대 0.5초(또는 10 step)에 한 번만 하도록 제한
+        with tqdm(total=num_batches, disable=not is_main, mininterval=0.5, miniters=10) as pbar:
+            pbar.set_description('[Epoch {}]'.format(epoch + 1))
+            for step, (img, gt_score_map, gt_geo_map, roi_mask) in enumerate(train_prefetcher):
+                # accum_steps개의 micro-batch마다(epoch 마지막 batch 포함) 한 번씩 update
+                is_update_step = (step + 1) % accum_steps == 0 or step + 1 == num_batches
+                # loss는 현재 group의 실제 micro-batch 수로 나눠서 마지막 group의 update도 같은 크기가 되도록 함
+                group_size = accum_steps if step < last_group_start else num_batches - last_group_start
+                # DDP의 forward를 거쳐야 gradient all-reduce가 backward와 겹쳐서 수행됨
+                # update하지 않는 micro-batch에서는 no_sync()로 all-reduce를 생략
+                sync_context = model.no_sync() if distributed and not is_update_step else nullcontext()
+                with sync_context:
+                    with torch.cuda.amp.autocast(enabled=amp, dtype=torch.float16):
+                        pred_score_map, pred_geo_map = train_forward(img)
+                    # loss는 autocast 밖에서 fp32로 계산 (geo map의 넓이 계산이 fp16 범위(65504)를 넘어 inf/NaN이 됨)
+                    loss, extra_info = criterion(gt_score_map, pred_score_map.float(), gt_geo_map,
+                                                 pred_geo_map.float(), roi_mask, detach_values=True)
+                    scaler.scale(loss / group_size).backward()
+
+                if is_update_step:
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
+
+                epoch_loss += loss.detach()
 
                 pbar.update(1)
-                val_dict = {
-                    'Cls loss': extra_info['cls_loss'], 'Angle loss': extra_info['angle_loss'],
-                    'IoU loss': extra_info['iou_loss']
-                }
-                pbar.set_postfix(val_dict)
-                wandb.log(val_dict)
+                step_values.append(torch.stack([extra_info['cls_loss'], extra_info['angle_loss'],
+                                                extra_info['iou_loss']]))
+                global_step += 1
+                # log_interval step마다 한 번만 GPU → CPU로 옮기고, 구간 평균값을 출력/로깅
+                if (step + 1) % log_interval == 0 or step + 1 == num_batches:
+                    interval_values = torch.stack(step_values).cpu()
+                    epoch_values += interval_values.sum(dim=0)
+                    cls_loss, angle_loss, iou_loss = interval_values.mean(dim=0).tolist()
+                    val_dict = {
+                        'Cls loss': cls_loss, 'Angle loss': angle_loss, 'IoU loss': iou_loss
+                    }
+                    pbar.set_postfix(val_dict, refresh=False)
+                    if is_main:
+                        wandb.log(val_dict, step=global_step)
+                    step_values = []
 
         scheduler.step()
-
-        
-        print('Mean loss: {:.4f} | Elapsed time: {} | early stop count : {}'.format(
-            epoch_loss / num_batches, timedelta(seconds=time.time() - epoch_start), early_stop_cnt))
+        if distributed:
+            # 모든 rank의 loss 평균을 사용해서 best/early stop 판단이 rank마다 달라지지 않도록 함
+            dist.all_reduce(epoch_loss)
+            epoch_loss /= world_size
+        epoch_loss = epoch_loss.item()
+
+        if is_main:
+            cls_loss, angle_loss, iou_loss = (epoch_values / num_batches).tolist()
+            wandb.log({
+                'Mean cls loss': cls_loss, 'Mean angle loss': angle_loss,
+                'Mean IoU loss': iou_loss
+            }, step=global_step)
+
+            print('Mean loss: {:.4f} | Elapsed time: {} | early stop count : {}'.format(
+                epoch_loss / num_batches, timedelta(seconds=time.time() - epoch_start), early_stop_cnt))
 
         if best_score > epoch_loss : # 이후에 요 epoch_loss와 부등호만 반대로 해주면 f1성능으로 평가 가능
             best_score = epoch_loss
-            print(f'New Best Model ->Epoch [{epoch+1}] / best_score : [{best_score}]')
-            best_pth_name = f'best_model.pth'
-            ckpt_fpath = osp.join(model_dir, best_pth_name)
-            torch.save(model.state_dict(),ckpt_fpath)
+            if is_main:
+                print(f'New Best Model ->Epoch [{epoch+1}] / best_score : [{best_score}]')
+                ckpt_futures.append(ckpt_executor.submit(save_checkpoint, cpu_state_dict(model_without_ddp),
+                                                         best_ckpt_fpath))
             #symlink_force(pth_name, osp.join(model_dir, "latest.pth"))
             #원하는 경우 best로 설정
 
@@ -130,29 +288,33 @@ def do_training(data_dir, model_dir, device, image_size, input_size, num_workers
             early_stop_cnt +=1
 
         if early_stop_cnt > early_stop:
-            print(f'no more best model training')
+            if is_main:
+                print(f'no more best model training')
             break
             
 
-        if (epoch + 1) % save_interval == 0:
-            if not osp.exists(model_dir):
-                os.makedirs(model_dir)
-
+        if is_main and (epoch + 1) % save_interval == 0:
             now = datetime.now()
-            pth_name = f'{epoch+1}epoch_{now.strftime("%y%m%d_%H%M%S")}.pth'
-
-            ckpt_fpath = osp.join(model_dir, pth_name)
-            torch.save(model.state_dict(), ckpt_fpath)
-            symlink_force(pth_name, osp.join(model_dir, "latest.pth"))
+            ckpt_fpath = osp.join(model_dir, f'{epoch+1}epoch_{now.strftime("%y%m%d_%H%M%S")}.pth')
+            ckpt_futures.append(ckpt_executor.submit(save_checkpoint, cpu_state_dict(model_without_ddp),
+                                                     ckpt_fpath, latest_link_fpath))
         
         
 
+    for future in ckpt_futures:
+        future.result()
+    ckpt_executor.shutdown()
+
+    if distributed:
+        dist.destroy_process_group()
+
 
 def main(args):
-    wandb.init(project="OCR Data annotation",
-               entity="light-observer",
-               name=args.wandb_name
-              )
+    if int(os.environ.get('RANK', 0)) == 0:
+        wandb.init(project="OCR Data annotation",
+                   entity="light-observer",
+                   name=args.wandb_name
+                  )
     do_training(**args.__dict__)
 
 
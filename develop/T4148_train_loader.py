@@ -4,13 +4,19 @@ import errno
 import os.path as osp
 import time
 import math
+import inspect
 import json
 from datetime import datetime, timedelta
-from argparse import ArgumentParser
+from functools import partial
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser, ArgumentTypeError
 
 import torch
+import torch.distributed as dist
 from torch import cuda
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import DataLoader, DistributedSampler
 from torch.optim import lr_scheduler
 from tqdm import tqdm
 from glob import glob
@@ -19,9 +25,10 @@ import cv2
 import numpy as np
 import random
 
-from east_dataset import EASTDataset
+from east_dataset import EASTDataset, CachedEASTDataset
 from dataset import SceneTextDataset
 from model import EAST
+from prefetcher import CUDAPrefetcher
 from detect import detect
 from deteval import calc_deteval_metrics
 
@@ -39,6 +46,18 @@ def symlink_force(target, link_name):
             raise e
 
 
+def cpu_state_dict(model):
+    # 학습이 계속 진행되어도 저장되는 값이 바뀌지 않도록 항상 CPU 사본을 만듦
+    return {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+
+
+def save_checkpoint(state_dict, ckpt_fpath, link_fpath=None):
+    # ckpt_executor thread에서 실행: 저장이 끝난 뒤에 symlink를 갱신해서 link가 미완성 파일을 가리키지 않도록 함
+    torch.save(state_dict, ckpt_fpath)
+    if link_fpath is not None:
+        symlink_force(osp.basename(ckpt_fpath), link_fpath)
+
+
 def str2bool(v):
     if isinstance(v, bool):
        return v
@@ -47,7 +66,14 @@ def str2bool(v):
     elif v.lower() in ('no', 'false', 'f', 'n', '0'):
         return False
     else:
-        raise argparse.ArgumentTypeError('Boolean value expected.')
+        raise ArgumentTypeError('Boolean value expected.')
+
+
+def seed_worker(worker_id, seed):
+    worker_seed = seed + worker_id
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+    torch.manual_seed(worker_seed)
 
 
 def parse_args():
@@ -73,12 +99,28 @@ def parse_args():
     parser.add_argument('--use_val', type=str2bool, default=True)
     parser.add_argument('--val_interval', type=int, default=1)
     parser.add_argument('--early_stop', type=int, default=20)
+    parser.add_argument('--amp', type=str2bool, default=cuda.is_available())
+    parser.add_argument('--deterministic', type=str2bool, default=False)
+    parser.add_argument('--accum_steps', type=int, default=1)
+    parser.add_argument('--log_interval', type=int, default=50)
+    parser.add_argument('--cache_dir', type=str, default=None)
+    parser.add_argument('--torch_compile', type=str2bool, default=cuda.is_available() and hasattr(torch, 'compile'))
+    parser.add_argument('--dist_timeout', type=int, default=120)
 
     args = parser.parse_args()
 
     if args.input_size % 32 != 0:
         raise ValueError('`input_size` must be a multiple of 32')
 
+    if args.accum_steps < 1:
+        raise ValueError('`accum_steps` must be a positive integer')
+
+    if args.log_interval < 1:
+        raise ValueError('`log_interval` must be a positive integer')
+
+    if args.dist_timeout < 1:
+        raise ValueError('`dist_timeout` must be a positive integer (minutes)')
+
     if args.use_val == True and osp.isfile(osp.join(args.data_dir, 'ufo/val.json')) == False:
         print('Not found: val.json → Please set use_val=False or create val.json!')
         print('[Warning]: Force reset use_val=False')
@@ -88,127 +130,256 @@ def parse_args():
 
 
 def do_training(data_dir, model_dir, device, image_size, input_size, num_workers, batch_size,
-                learning_rate, max_epoch, save_interval, wandb_name, seed, use_val, val_interval, early_stop):
+                learning_rate, max_epoch, save_interval, wandb_name, seed, use_val, val_interval, early_stop,
+                amp, deterministic, torch_compile, accum_steps, log_interval, cache_dir, dist_timeout):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed) # if use multi-GPU
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    if deterministic:
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+    else:
+        # input_size가 고정이므로 첫 batch의 cuDNN autotune 비용은 바로 상쇄됨
+        torch.backends.cudnn.deterministic = False
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
     np.random.seed(seed)
     random.seed(seed)
 
+    # torchrun으로 실행한 경우(LOCAL_RANK 환경변수 존재) DDP로 multi-GPU 학습
+    distributed = 'LOCAL_RANK' in os.environ
+    if distributed:
+        local_rank = int(os.environ['LOCAL_RANK'])
+        torch.cuda.set_device(local_rank)
+        # validation은 rank 0에서만 수행되고 그동안 다른 rank는 stop flag broadcast에서 대기하므로
+        # collective timeout(분 단위)은 validation 한 번보다 충분히 길어야 함
+        dist.init_process_group('nccl', timeout=timedelta(minutes=dist_timeout))
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        device = torch.device('cuda', local_rank)
+    else:
+        rank, world_size = 0, 1
+    # wandb 로깅, 출력, checkpoint 저장은 rank 0에서만 수행
+    is_main = rank == 0
+
     train_dataset= SceneTextDataset(data_dir, split='train', image_size=image_size, crop_size=input_size)
     train_dataset = EASTDataset(train_dataset)
-    train_num_batches = math.ceil(len(train_dataset) / batch_size)
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers, worker_init_fn=np.random.seed(seed))
+    if cache_dir is not None:
+        cache_meta = dict(data_dir=osp.abspath(data_dir), split='train', image_size=image_size,
+                          crop_size=input_size, map_scale=train_dataset.map_scale)
+        train_dataset = CachedEASTDataset(train_dataset, cache_dir, meta=cache_meta)
+        if is_main:
+            # cache에는 처음 만들 때의 random augmentation 결과가 그대로 저장되므로 epoch마다 같은 sample이 나옴
+            print('[Warning] --cache_dir freezes the random train augmentation (crop, rotation, color jitter, '
+                  'noise) drawn on the first pass: every later epoch sees the same sample per index')
+    # worker는 epoch마다 재생성하지 않고 유지(persistent), seed는 worker별로 다르게 설정
+    worker_kwargs = dict(worker_init_fn=partial(seed_worker, seed=seed + rank * num_workers),
+                         persistent_workers=True, prefetch_factor=4) if num_workers > 0 else dict()
+    train_sampler = DistributedSampler(train_dataset, shuffle=True, seed=seed) if distributed else None
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=train_sampler is None, sampler=train_sampler,
+                              num_workers=num_workers, pin_memory=torch.device(device).type == 'cuda', **worker_kwargs)
+    train_num_batches = len(train_loader)
+    # epoch 마지막 accumulation group은 accum_steps보다 작을 수 있으므로 시작 위치를 미리 계산
+    last_group_start = train_num_batches - train_num_batches % accum_steps
+    train_prefetcher = CUDAPrefetcher(train_loader, device, memory_format=torch.channels_last)
 
 
     val_dataset = SceneTextDataset(data_dir, split='val', image_size=image_size, crop_size=input_size)
     #val_dataset = EASTDataset(val_dataset)
     val_num_batches = math.ceil(len(val_dataset) / batch_size)
-    val_loader = DataLoader(val_dataset, batch_size=1, shuffle=False, num_workers=num_workers)
+    # val 이미지는 detect()에서 CPU 전처리를 거치므로 pin_memory는 사용하지 않음
+    val_loader = DataLoader(val_dataset, batch_size=1, shuffle=False, num_workers=num_workers,
+                            persistent_workers=num_workers > 0)
 
     model = EAST()
-    model.to(device)
-    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, betas=(0.9,0.999), weight_decay=0.01)
+    model.to(device, memory_format=torch.channels_last)
+    criterion = model.criterion
+    model_without_ddp = model
+    if distributed:
+        model = DDP(model, device_ids=[local_rank], bucket_cap_mb=25, gradient_as_bucket_view=True)
+        if torch_compile:
+            # DDP로 감싼 model을 compile해야 DDPOptimizer가 bucket 경계에서 graph를 나눠서
+            # all-reduce가 backward와 겹쳐짐 (CUDA graph를 쓰는 reduce-overhead mode는 사용하지 않음)
+            model = torch.compile(model, dynamic=False)
+    # 학습 step에서만 쓰는 forward. model.forward는 eager로 두어 validation(detect)이 학습용 CUDA graph를
+    # 재compile하거나 별도 memory pool을 만들지 않도록 함
+    train_forward = model
+    if torch_compile and not distributed:
+        # loss 계산(data-dependent 분기 포함)은 제외하고 forward만 compile → state_dict key도 그대로 유지됨
+        train_forward = torch.compile(model.forward, mode='reduce-overhead', dynamic=False)
+    # fused(단일 CUDA 커널) → foreach(multi-tensor) 순으로 지원되는 AdamW 구현 사용
+    adamw_params = inspect.signature(torch.optim.AdamW).parameters
+    adamw_kwargs = dict()
+    if torch.device(device).type == 'cuda':
+        if 'fused' in adamw_params:
+            adamw_kwargs['fused'] = True
+        elif 'foreach' in adamw_params:
+            adamw_kwargs['foreach'] = True
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, betas=(0.9,0.999), weight_decay=0.01,
+                                  **adamw_kwargs)
     scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=[max_epoch // 2], gamma=0.1)
+    scaler = torch.cuda.amp.GradScaler(enabled=amp)
+    # checkpoint의 디스크 저장은 별도 thread에서 수행해서 학습 loop를 막지 않도록 함
+    ckpt_executor = ThreadPoolExecutor(max_workers=1)
+    ckpt_futures = []
+    # checkpoint 경로 관련 값은 학습 시작 전에 한 번만 준비
+    if is_main:
+        os.makedirs(model_dir, exist_ok=True)
+    pth_prefix = osp.join(model_dir, (wandb_name.replace(" ","_")).lower())
+    best_link_fpath, latest_link_fpath = osp.join(model_dir, "best_model.pth"), osp.join(model_dir, "latest.pth")
 
 
     stop_cnt = 0
     best_score = 0
+    global_step = 0
     for epoch in range(max_epoch):
         model.train()
-        epoch_loss, epoch_start = 0, time.time()
-        with tqdm(total=train_num_batches) as pbar:
-            for img, gt_score_map, gt_geo_map, roi_mask in train_loader:
-                pbar.set_description('[Epoch {}]'.format(epoch + 1))
-
-                loss, extra_info = model.train_step(img, gt_score_map, gt_geo_map, roi_mask)
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-
-                loss_val = loss.item()
-                epoch_loss += loss_val
+        # epoch loss는 GPU에서 누적하고 epoch이 끝날 때 한 번만 동기화
+        epoch_loss, epoch_start = torch.zeros((), device=device), time.time()
+        step_values, epoch_values = [], torch.zeros(3)
+        if distributed:
+            train_sampler.set_epoch(epoch)
+        # 화면 갱신은 최대 0.5초(또는 10 step)에 한 번만 하도록 제한
+        with tqdm(total=train_num_batches, disable=not is_main, mininterval=0.5, miniters=10) as pbar:
+            pbar.set_description('[Epoch {}]'.format(epoch + 1))
+            for step, (img, gt_score_map, gt_geo_map, roi_mask) in enumerate(train_prefetcher):
+                # accum_steps개의 micro-batch마다(epoch 마지막 batch 포함) 한 번씩 update
+                is_update_step = (step + 1) % accum_steps == 0 or step + 1 == train_num_batches
+                # loss는 현재 group의 실제 micro-batch 수로 나눠서 마지막 group의 update도 같은 크기가 되도록 함
+                group_size = accum_steps if step < last_group_start else train_num_batches - last_group_start
+                # DDP의 forward를 거쳐야 gradient all-reduce가 backward와 겹쳐서 수행됨
+                # update하지 않는 micro-batch에서는 no_sync()로 all-reduce를 생략
+                sync_context = model.no_sync() if distributed and not is_update_step else nullcontext()
+                with sync_context:
+                    with torch.cuda.amp.autocast(enabled=amp, dtype=torch.float16):
+                        pred_score_map, pred_geo_map = train_forward(img)
+                    # loss는 autocast 밖에서 fp32로 계산 (geo map의 넓이 계산이 fp16 범위(65504)를 넘어 inf/NaN이 됨)
+                    loss, extra_info = criterion(gt_score_map, pred_score_map.float(), gt_geo_map,
+                                                 pred_geo_map.float(), roi_mask, detach_values=True)
+                    scaler.scale(loss / group_size).backward()
+
+                if is_update_step:
+                    scaler.unscale_(optimizer)
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+                    scaler.step(optimizer)
+                    scaler.update()
+                    optimizer.zero_grad(set_to_none=True)
+
+                epoch_loss += loss.detach()
 
                 pbar.update(1)
-                val_dict = {
-                    'Cls loss': extra_info['cls_loss'], 'Angle loss': extra_info['angle_loss'],
-                    'IoU loss': extra_info['iou_loss']
-                }
-                pbar.set_postfix(val_dict)
-                wandb.log({
-                    'Train/Cls loss': extra_info['cls_loss'], 'Train/Angle loss': extra_info['angle_loss'],
-                    'Train/IoU loss': extra_info['iou_loss']
-                })
+                step_values.append(torch.stack([extra_info['cls_loss'], extra_info['angle_loss'],
+                                                extra_info['iou_loss']]))
+                global_step += 1
+                # log_interval step마다 한 번만 GPU → CPU로 옮기고, 구간 평균값을 출력/로깅
+                if (step + 1) % log_interval == 0 or step + 1 == train_num_batches:
+                    interval_values = torch.stack(step_values).cpu()
+                    epoch_values += interval_values.sum(dim=0)
+                    cls_loss, angle_loss, iou_loss = interval_values.mean(dim=0).tolist()
+                    val_dict = {
+                        'Cls loss': cls_loss, 'Angle loss': angle_loss, 'IoU loss': iou_loss
+                    }
+                    pbar.set_postfix(val_dict, refresh=False)
+                    if is_main:
+                        wandb.log({
+                            'Train/Cls loss': cls_loss, 'Train/Angle loss': angle_loss,
+                            'Train/IoU loss': iou_loss
+                        }, step=global_step)
+                    step_values = []
 
         scheduler.step()
+        if distributed:
+            # 모든 rank의 loss 평균을 사용해서 best/early stop 판단이 rank마다 달라지지 않도록 함
+            dist.all_reduce(epoch_loss)
+            epoch_loss /= world_size
+        epoch_loss = epoch_loss.item()
+
+        if is_main:
+            cls_loss, angle_loss, iou_loss = (epoch_values / train_num_batches).tolist()
+            wandb.log({
+                'Train/Mean cls loss': cls_loss, 'Train/Mean angle loss': angle_loss,
+                'Train/Mean IoU loss': iou_loss
+            }, step=global_step)
+
+            if stop_cnt == 0 :
+                print('Mean loss: {:.4f} | Elapsed time: {}'.format(
+                    epoch_loss / train_num_batches, timedelta(seconds=time.time() - epoch_start)))
+            else:
+                print('Mean loss: {:.4f} | Elapsed time: {} | no more best count : {}'.format(
+                    epoch_loss / train_num_batches, timedelta(seconds=time.time() - epoch_start), stop_cnt))
 
-        if stop_cnt == 0 :
-            print('Mean loss: {:.4f} | Elapsed time: {}'.format(
-                epoch_loss / train_num_batches, timedelta(seconds=time.time() - epoch_start)))
-        else:
-            print('Mean loss: {:.4f} | Elapsed time: {} | no more best count : {}'.format(
-                epoch_loss / train_num_batches, timedelta(seconds=time.time() - epoch_start), stop_cnt))
-
-        if use_val and (epoch + 1) % val_interval == 0:
-            with torch.no_grad():
-                model.eval()
+        # validation은 rank 0에서 DDP로 감싸지 않은 model로만 수행
+        if is_main and use_val and (epoch + 1) % val_interval == 0:
+            model_without_ddp.eval()
+            with torch.inference_mode(), torch.cuda.amp.autocast(enabled=amp, dtype=torch.float16):
                 with tqdm(val_loader) as pbar:
-
-                    pred_bboxes = []
-
-                    for _, value in enumerate(pbar):
-                        image, gt_word_bboxes, roi_mask = value
-                        val_start = time.time()
-                        pbar.set_description('[inferencing] : ')
-                        pred_bboxes.extend(detect(model, image, input_size))
-                        ret = calc_deteval_metrics(pred_bboxes, gt_word_bboxes, verbose=True)
-                        print(" ".join([f"F1: {ret['total']['hmean']:.4f}",
-                                        f"Precision: {ret['total']['precision']:.4f}",
-                                        f"Recall: {ret['total']['recall']:.4f}",
-                                        f"| Elapsed time: {timedelta(seconds=time.time() - val_start)}"
-                                    ]))
-                        wandb.log({
-                            'Val/Precision': ret['total']['precision'], 'Val/Recall': ret['total']['recall'],
-                            'Val/F1': ret['total']['hmean']
-                        })
+                    pbar.set_description('[inferencing] : ')
+                    val_start = time.time()
+
+                    # 예측/GT box는 이미지별로 모아두고 metric은 loop가 끝난 뒤 한 번만 계산
+                    pred_bboxes_dict, gt_bboxes_dict = dict(), dict()
+
+                    for idx, (image, gt_word_bboxes) in enumerate(pbar):
+                        pred_bboxes_dict[idx] = detect(model_without_ddp, image.numpy(), input_size)[0]
+                        gt_bboxes_dict[idx] = gt_word_bboxes[0].numpy()
+
+            ret = calc_deteval_metrics(pred_bboxes_dict, gt_bboxes_dict)
+            print(" ".join([f"F1: {ret['total']['hmean']:.4f}",
+                            f"Precision: {ret['total']['precision']:.4f}",
+                            f"Recall: {ret['total']['recall']:.4f}",
+                            f"| Elapsed time: {timedelta(seconds=time.time() - val_start)}"
+                        ]))
+            wandb.log({
+                'Val/Precision': ret['total']['precision'], 'Val/Recall': ret['total']['recall'],
+                'Val/F1': ret['total']['hmean']
+            }, step=global_step)
 
             f1_score = ret['total']['hmean']
 
             if best_score < f1_score :
                 best_score = f1_score
                 print(f'New Best Model -> Epoch [{epoch+1}] / best_score : [{best_score :.4}]')
-                best_pth_name = f'{(wandb_name.replace(" ","_")).lower()}_best_model.pth'
-                ckpt_fpath = osp.join(model_dir, best_pth_name)
-                torch.save(model.state_dict(),ckpt_fpath)
-                symlink_force(best_pth_name, osp.join(model_dir, "best_model.pth"))
+                ckpt_fpath = f'{pth_prefix}_best_model.pth'
+                ckpt_futures.append(ckpt_executor.submit(save_checkpoint, cpu_state_dict(model_without_ddp),
+                                                         ckpt_fpath, best_link_fpath))
                 stop_cnt = 0
             
             else:
                 stop_cnt +=1
 
-        if (epoch + 1) % save_interval == 0:
-            if not osp.exists(model_dir):
-                os.makedirs(model_dir)
+        if is_main and (epoch + 1) % save_interval == 0:
             now = datetime.now()
-            pth_name = f'{(wandb_name.replace(" ","_")).lower()}_{epoch+1}epoch_{now.strftime("%y%m%d_%H%M%S")}.pth'
+            ckpt_fpath = f'{pth_prefix}_{epoch+1}epoch_{now.strftime("%y%m%d_%H%M%S")}.pth'
+            ckpt_futures.append(ckpt_executor.submit(save_checkpoint, cpu_state_dict(model_without_ddp),
+                                                     ckpt_fpath, latest_link_fpath))
 
-            ckpt_fpath = osp.join(model_dir, pth_name)
-            torch.save(model.state_dict(), ckpt_fpath)
-            symlink_force(pth_name, osp.join(model_dir, "latest.pth"))
 
+        stop_training = stop_cnt > early_stop
+        if distributed:
+            # early stop 판단은 rank 0의 validation 결과로 하므로 다른 rank에도 전달
+            stop_flag = torch.tensor(int(stop_training), device=device)
+            dist.broadcast(stop_flag, src=0)
+            stop_training = bool(stop_flag.item())
 
-        if stop_cnt > early_stop :
-            print(f'no more best model training | Training is over')
+        if stop_training:
+            if is_main:
+                print(f'no more best model training | Training is over')
             break
 
+    for future in ckpt_futures:
+        future.result()
+    ckpt_executor.shutdown()
+
+    if distributed:
+        dist.destroy_process_group()
+
 
 def main(args):
-    wandb.init(project="OCR Data annotation",
-               entity="light-observer",
-               name=args.wandb_name
-              )
+    if int(os.environ.get('RANK', 0)) == 0:
+        wandb.init(project="OCR Data annotation",
+                   entity="light-observer",
+                   name=args.wandb_name
+                  )
     do_training(**args.__dict__)
 
 
@@ -1,4 +1,10 @@
+import os
+import os.path as osp
 import math
+import json
+import time
+import shutil
+import tempfile
 
 import torch
 import numpy as np
@@ -25,10 +31,10 @@ def shrink_bbox(bbox, coef=0.3, inplace=False):
     return bbox
 
 
-def get_rotated_coords(h, w, theta, anchor):
+def get_rotated_coords(h, w, theta, anchor, offset=(0, 0)):
     anchor = anchor.reshape(2, 1)
     rotate_mat = get_rotate_mat(theta)
-    x, y = np.meshgrid(np.arange(w), np.arange(h))
+    x, y = np.meshgrid(np.arange(w) + offset[0], np.arange(h) + offset[1])
     x_lin = x.reshape((1, x.size))
     y_lin = y.reshape((1, x.size))
     coord_mat = np.concatenate((x_lin, y_lin), 0)
@@ -63,20 +69,28 @@ def rotate_bbox(bbox, theta, anchor=None):
     return rotated_points.T
 
 
+# candidate angles of find_min_rect_angle and their rotation matrices, shape (n_angles, 2, 2)
+CANDIDATE_ANGLES = np.arange(-90, 90) / 180 * math.pi
+CANDIDATE_ROTATE_MATS = np.stack([np.stack([np.cos(CANDIDATE_ANGLES), -np.sin(CANDIDATE_ANGLES)], axis=1),
+                                  np.stack([np.sin(CANDIDATE_ANGLES), np.cos(CANDIDATE_ANGLES)], axis=1)],
+                                 axis=1)
+
+
 def find_min_rect_angle(bbox, rank_num=10):
     '''Find the best angle to rotate poly and obtain min rectangle
     '''
-    areas = []
-    angles = np.arange(-90, 90) / 180 * math.pi
-    for theta in angles:
-        rotated_bbox = rotate_bbox(bbox, theta)
-        x_min, y_min = np.min(rotated_bbox, axis=0)
-        x_max, y_max = np.max(rotated_bbox, axis=0)
-        areas.append((x_max - x_min) * (y_max - y_min))
+    angles = CANDIDATE_ANGLES
+
+    # rotate the bbox by every candidate angle at once, (n_angles, 2, 2) @ (2, 4)
+    points = bbox.T
+    anchor = points[:, :1]
+    rotated_points = np.matmul(CANDIDATE_ROTATE_MATS, points - anchor) + anchor
+    extents = rotated_points.max(axis=2) - rotated_points.min(axis=2)
+    areas = extents[:, 0] * extents[:, 1]
 
     best_angle, min_error = -1, float('inf')
     for idx in np.argsort(areas)[:rank_num]:
-        rotated_bbox = rotate_bbox(bbox, angles[idx])
+        rotated_bbox = rotated_points[idx].T
         error = calc_error_from_rect(rotated_bbox)
         if error < min_error:
             best_angle, min_error = angles[idx], error
@@ -98,8 +112,14 @@ def generate_score_geo_maps(image, word_bboxes, map_scale=0.25):
         poly = np.around(map_scale * shrink_bbox(bbox)).astype(np.int32)
         word_polys.append(poly)
 
-        center_mask = np.zeros((map_h, map_w), np.float32)
-        cv2.fillPoly(center_mask, [poly], 1)
+        # center_mask is zero outside the bounding box of poly, so only fill in that window
+        x0, y0 = np.maximum(poly.min(axis=0), 0)
+        x1, y1 = np.minimum(poly.max(axis=0) + 1, (map_w, map_h))
+        if x0 >= x1 or y0 >= y1:
+            continue
+
+        center_mask = np.zeros((y1 - y0, x1 - x0), np.float32)
+        cv2.fillPoly(center_mask, [(poly - (x0, y0)).astype(np.int32)], 1)
 
         theta = find_min_rect_angle(bbox)
         rotated_bbox = rotate_bbox(bbox, theta) * map_scale
@@ -107,7 +127,7 @@ def generate_score_geo_maps(image, word_bboxes, map_scale=0.25):
         x_max, y_max = np.max(rotated_bbox, axis=0)
 
         anchor = bbox[0] * map_scale
-        rotated_x, rotated_y = get_rotated_coords(map_h, map_w, theta, anchor)
+        rotated_x, rotated_y = get_rotated_coords(y1 - y0, x1 - x0, theta, anchor, offset=(x0, y0))
 
         d1, d2 = rotated_y - y_min, y_max - rotated_y
         d1[d1 < 0] = 0
@@ -115,11 +135,12 @@ def generate_score_geo_maps(image, word_bboxes, map_scale=0.25):
         d3, d4 = rotated_x - x_min, x_max - rotated_x
         d3[d3 < 0] = 0
         d4[d4 < 0] = 0
-        geo_map[:, :, 0] += d1 * center_mask * inv_scale
-        geo_map[:, :, 1] += d2 * center_mask * inv_scale
-        geo_map[:, :, 2] += d3 * center_mask * inv_scale
-        geo_map[:, :, 3] += d4 * center_mask * inv_scale
-        geo_map[:, :, 4] += theta * center_mask
+        geo_window = geo_map[y0:y1, x0:x1]
+        geo_window[:, :, 0] += d1 * center_mask * inv_scale
+        geo_window[:, :, 1] += d2 * center_mask * inv_scale
+        geo_window[:, :, 2] += d3 * center_mask * inv_scale
+        geo_window[:, :, 3] += d4 * center_mask * inv_scale
+        geo_window[:, :, 4] += theta * center_mask
 
     cv2.fillPoly(score_map, word_polys, 1)
 
@@ -151,3 +172,84 @@ class EASTDataset(Dataset):
 
     def __len__(self):
         return len(self.dataset)
+
+
+class CachedEASTDataset(Dataset):
+    '''Store each (image, score_map, geo_map, roi_mask) sample of `dataset` as .npy files
+    in its own directory under cache_dir the first time it is requested, and memory-map them afterwards.
+    The random augmentation of the wrapped dataset is frozen to what was drawn on the
+    first pass, so the cache is tied to the dataset options (image_size, input_size, ...).
+    Input:
+        dataset: EASTDataset to cache
+        cache_dir: directory for the cached samples, may be reused across runs
+        meta: dict of the options the samples depend on (data_dir, image_size, ...). It is stored
+            with the cache and ValueError is raised if an existing cache was built with other options
+    '''
+    array_names = ('image', 'score_map', 'geo_map', 'roi_mask')
+    meta_fname = 'meta.json'
+    # temp dirs older than this were left behind by killed writers (a sample is written in well under a second)
+    stale_tmp_seconds = 600
+
+    def __init__(self, dataset, cache_dir, meta=None):
+        self.dataset = dataset
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._check_meta(dict(meta or {}, num_samples=len(dataset)))
+        self._remove_stale_tmp_dirs()
+
+    def _check_meta(self, meta):
+        meta_fpath = osp.join(self.cache_dir, self.meta_fname)
+        # round-trip through json so tuples etc. compare equal to what is read back
+        meta = json.loads(json.dumps(meta, sort_keys=True))
+
+        if not osp.exists(meta_fpath):
+            # every rank of a run writes the same content, so a concurrent replace is harmless
+            tmp_fpath = '{}.{}.tmp'.format(meta_fpath, os.getpid())
+            with open(tmp_fpath, 'w') as f:
+                json.dump(meta, f, indent=4, sort_keys=True)
+            os.replace(tmp_fpath, meta_fpath)
+            return
+
+        with open(meta_fpath, 'r') as f:
+            cached_meta = json.load(f)
+        if cached_meta != meta:
+            diff = {key: (cached_meta.get(key), meta.get(key))
+                    for key in sorted(set(cached_meta) | set(meta)) if cached_meta.get(key) != meta.get(key)}
+            raise ValueError('cache_dir {} was built with other dataset options (cached, current): {}. '
+                             'Use a new cache_dir or remove the old one'.format(self.cache_dir, diff))
+
+    def _remove_stale_tmp_dirs(self):
+        # recent temp dirs may still be in use by another rank that is already writing samples
+        now = time.time()
+        for fname in os.listdir(self.cache_dir):
+            tmp_dir = osp.join(self.cache_dir, fname)
+            try:
+                if fname.startswith('.tmp_') and now - osp.getmtime(tmp_dir) > self.stale_tmp_seconds:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+            except OSError:
+                continue
+
+    def __getitem__(self, idx):
+        sample_dir = osp.join(self.cache_dir, '{:06d}'.format(idx))
+
+        if osp.isdir(sample_dir):
+            # copy-on-write mapping is writable, so torch.from_numpy can wrap it without copying;
+            # pages are only read when the batch is collated
+            arrays = [np.load(osp.join(sample_dir, name + '.npy'), mmap_mode='c') for name in self.array_names]
+        else:
+            arrays = [x.numpy() if torch.is_tensor(x) else x for x in self.dataset[idx]]
+            # write into a private temp dir and rename it into place. The rename is atomic and fails
+            # if another rank/worker already stored this idx, so a cached sample is never partial or
+            # a mix of two differently augmented draws
+            tmp_dir = tempfile.mkdtemp(prefix='.tmp_', dir=self.cache_dir)
+            for array, name in zip(arrays, self.array_names):
+                np.save(osp.join(tmp_dir, name + '.npy'), array)
+            try:
+                os.rename(tmp_dir, sample_dir)
+            except OSError:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        return tuple(torch.from_numpy(array) for array in arrays)
+
+    def __len__(self):
+        return len(self.dataset)
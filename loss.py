@@ -27,7 +27,7 @@ class EASTLoss(nn.Module):
         super().__init__()
         self.weight_angle = weight_angle
 
-    def forward(self, gt_score, pred_score, gt_geo, pred_geo, roi_mask):
+    def forward(self, gt_score, pred_score, gt_geo, pred_geo, roi_mask, detach_values=False):
         if torch.sum(gt_score) < 1:
             return torch.sum(pred_score + pred_geo) * 0
 
@@ -40,5 +40,9 @@ class EASTLoss(nn.Module):
         geo_loss = angle_loss + iou_loss
         total_loss = classify_loss + geo_loss
 
+        # detach_values=True이면 .item()으로 인한 GPU 동기화 없이 detach된 tensor를 그대로 반환
+        if detach_values:
+            return total_loss, dict(cls_loss=classify_loss.detach(), angle_loss=angle_loss.detach(),
+                                    iou_loss=iou_loss.detach())
         return total_loss, dict(cls_loss=classify_loss.item(), angle_loss=angle_loss.item(),
                                 iou_loss=iou_loss.item())
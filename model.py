@@ -170,7 +170,11 @@ class EAST(nn.Module):
         self.criterion = EASTLoss()
 
     def forward(self, x):
-        return self.output(self.merge(self.extractor(x)))
+        x = self.merge(self.extractor(x))
+        # keep the output head in fp32 under autocast: geo distances reach 512 px and would be
+        # rounded by up to 0.25-0.5 px in fp16 before box restoration / loss computation
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return self.output(x.float())
 
     def train_step(self, image, score_map, geo_map, roi_mask):
         device = list(self.parameters())[0].device
@@ -0,0 +1,52 @@
+import torch
+
+
+class CUDAPrefetcher:
+    '''Wrap a DataLoader so that the next batch is copied to the GPU on a side stream
+    while the current batch is being trained on.
+    Input:
+        loader: DataLoader yielding tuples of tensors (pin_memory=True recommended)
+        device: target device. On non-CUDA devices batches are simply moved with .to(device)
+        memory_format: layout for 4-D tensors, applied as part of the copy (e.g. torch.channels_last)
+    '''
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield tuple(self._to_device(tensor) for tensor in batch)
+            return
+
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            # side stream에서 할당된 메모리가 사용 중에 재사용되지 않도록 표시
+            for tensor in batch:
+                tensor.record_stream(current_stream)
+
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(self.stream):
+            return tuple(self._to_device(tensor, non_blocking=True) for tensor in batch)
+
+    def _to_device(self, tensor, non_blocking=False):
+        # layout 변환을 H2D 복사와 함께 side stream에서 처리 → 학습 loop에서 device copy를 한 번 더 하지 않음
+        memory_format = self.memory_format if tensor.dim() == 4 else torch.preserve_format
+        return tensor.to(self.device, non_blocking=non_blocking, memory_format=memory_format)